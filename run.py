@@ -1,613 +1,1911 @@
 #!/usr/bin/env python3
 
 import argparse
-import requests
+import codecs
+import copy
+import io
 import json
 import os
+import sys
+import re
+import threading
+import time
 import datetime
+import fnmatch
+import hashlib
+import heapq
+import random
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager, redirect_stderr
+from functools import lru_cache, partial
+from urllib.parse import urlparse
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 # import logging
 
 # logging.basicConfig(level=logging.INFO)
 
+CACHE_TTLS = {
+    'sizes': 3600,
+    'images': 3600,
+    'volume_types': 3600,
+    'templates': 600,
+    'machines': 15,
+    'console': 0,
+}
+DEFAULT_CACHE_TTL = 60
+
+def cache_ttl(url):
+    for segment in reversed(urlparse(url).path.strip('/').split('/')):
+        if segment in CACHE_TTLS:
+            return CACHE_TTLS[segment]
+    return DEFAULT_CACHE_TTL
+
+def iter_json_records(chunks):
+    decoder = json.JSONDecoder()
+    whitespace = re.compile(r'[\s,]*')
+    buffer = ''
+    pos = 0
+    in_array = None
+    chunks = iter(chunks)
+    for chunk in chunks:
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        if in_array is None:
+            pos = whitespace.match(buffer, pos).end()
+            if pos == len(buffer):
+                continue
+            in_array = buffer[pos] == '['
+            if not in_array:
+                break
+            pos += 1
+        while True:
+            pos = whitespace.match(buffer, pos).end()
+            if pos == len(buffer):
+                break
+            if buffer[pos] == ']':
+                return
+            try:
+                record, end = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                break
+            if not isinstance(record, (dict, list, str)) and buffer[end:end + 1] in ('', '.', 'e', 'E'):
+                break
+            yield record
+            pos = end
+    if in_array:
+        buffer = buffer[pos:].strip()
+        if buffer and buffer != ']':
+            raise ValueError(f'truncated JSON array: {buffer[:200]}')
+        return
+    document = buffer[pos:] + ''.join(chunks)
+    if document.strip():
+        yield json.loads(document)
+
+def iter_response_text(response, chunk_size=64 * 1024):
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b'', final=True)
+    if text:
+        yield text
+
+ENDPOINT_WORDS = {
+    'api', 'v1', 'tokens', 'platforms', 'platform', 'ping', 'clouds', 'cloud', 'clusters',
+    'cluster', 'hosts', 'host', 'machines', 'machine', 'machines_from_template', 'console',
+    'images', 'image', 'sizes', 'templates', 'template', 'action', 'networks', 'network',
+    'volumes', 'volume', 'volume_types', 'volume_type', 'security-groups', 'sync',
+    'update_poller', 'update_volume_poller',
+}
+
+def endpoint_template(url):
+    segments = urlparse(url).path.strip('/').split('/')
+    segments = [segment if segment in ENDPOINT_WORDS else '{id}' for segment in segments]
+    if segments[:2] == ['api', 'v1']:
+        segments = segments[2:]
+    return '/' + '/'.join(segments)
+
+request_timing = threading.local()
+
+@lru_cache(maxsize=None)
+def timed_adapter_class():
+    from requests.adapters import HTTPAdapter
+    from urllib3.connection import HTTPConnection, HTTPSConnection
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+    class TimedHTTPConnection(HTTPConnection):
+        def connect(self):
+            start = time.perf_counter()
+            super().connect()
+            request_timing.connect = time.perf_counter() - start
+
+    class TimedHTTPSConnection(HTTPSConnection):
+        def connect(self):
+            start = time.perf_counter()
+            super().connect()
+            request_timing.connect = time.perf_counter() - start
+
+    class TimedHTTPConnectionPool(HTTPConnectionPool):
+        ConnectionCls = TimedHTTPConnection
+
+    class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+        ConnectionCls = TimedHTTPSConnection
+
+    class TimedHTTPAdapter(HTTPAdapter):
+        def init_poolmanager(self, *args, **kwargs):
+            super().init_poolmanager(*args, **kwargs)
+            self.poolmanager.pool_classes_by_scheme = {
+                'http': TimedHTTPConnectionPool,
+                'https': TimedHTTPSConnectionPool,
+            }
+
+    return TimedHTTPAdapter
+
+class RequestTimings():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def record(self, method, url, status, connect, ttfb, total, size):
+        key = (method, endpoint_template(url))
+        with self.lock:
+            stats = self.endpoints.get(key)
+            if stats is None:
+                stats = self.endpoints[key] = {'connect': [], 'ttfb': [], 'total': [],
+                                               'bytes': 0, 'errors': 0}
+            stats['connect'].append(connect)
+            stats['ttfb'].append(ttfb)
+            stats['total'].append(total)
+            stats['bytes'] += size
+            if status is None or status >= 400:
+                stats['errors'] += 1
+
+    def summary(self):
+        with self.lock:
+            endpoints = sorted(self.endpoints.items(), key=lambda item: (item[0][1], item[0][0]))
+            rows = []
+            for (method, endpoint), stats in endpoints:
+                count = len(stats['total'])
+                rows.append({
+                    'method': method,
+                    'endpoint': endpoint,
+                    'count': count,
+                    'errors': stats['errors'],
+                    'bytes': stats['bytes'],
+                    'connect_avg': sum(stats['connect']) / count,
+                    'ttfb_avg': sum(stats['ttfb']) / count,
+                    'total_sum': sum(stats['total']),
+                    'p50': percentile(stats['total'], 50),
+                    'p95': percentile(stats['total'], 95),
+                    'p99': percentile(stats['total'], 99),
+                })
+            return rows
+
+    def print_summary(self, file=None):
+        file = file or sys.stderr
+        print(f"{'METHOD':<7}{'ENDPOINT':<55}{'COUNT':>7}{'ERR':>5}{'CONNECT':>9}{'TTFB':>9}"
+              f"{'P50':>9}{'P95':>9}{'P99':>9}{'KB':>10}", file=file)
+        for row in self.summary():
+            print(f"{row['method']:<7}{row['endpoint']:<55}{row['count']:>7}{row['errors']:>5}"
+                  f"{row['connect_avg']:>9.3f}{row['ttfb_avg']:>9.3f}{row['p50']:>9.3f}"
+                  f"{row['p95']:>9.3f}{row['p99']:>9.3f}{row['bytes'] / 1024:>10.1f}", file=file)
+
+    def prometheus(self):
+        lines = [
+            '# TYPE mist_api_request_duration_seconds summary',
+            '# TYPE mist_api_request_errors_total counter',
+            '# TYPE mist_api_response_bytes_total counter',
+            '# TYPE mist_api_connect_seconds_avg gauge',
+            '# TYPE mist_api_ttfb_seconds_avg gauge',
+        ]
+        for row in self.summary():
+            labels = f'method="{row["method"]}",endpoint="{row["endpoint"]}"'
+            for quantile, key in (('0.5', 'p50'), ('0.95', 'p95'), ('0.99', 'p99')):
+                lines.append(f'mist_api_request_duration_seconds{{{labels},quantile="{quantile}"}} '
+                             f'{row[key]:.6f}')
+            lines.append(f'mist_api_request_duration_seconds_sum{{{labels}}} {row["total_sum"]:.6f}')
+            lines.append(f'mist_api_request_duration_seconds_count{{{labels}}} {row["count"]}')
+            lines.append(f'mist_api_request_errors_total{{{labels}}} {row["errors"]}')
+            lines.append(f'mist_api_response_bytes_total{{{labels}}} {row["bytes"]}')
+            lines.append(f'mist_api_connect_seconds_avg{{{labels}}} {row["connect_avg"]:.6f}')
+            lines.append(f'mist_api_ttfb_seconds_avg{{{labels}}} {row["ttfb_avg"]:.6f}')
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path, format='json'):
+        with open(path, 'w') as file:
+            if format == 'prometheus':
+                file.write(self.prometheus())
+            else:
+                json.dump(self.summary(), file, indent=2)
+
+def env_enabled(name):
+    return os.getenv(name) in ('TRUE', 'true', 'YES', 'yes', 'ON', 'on', 1)
+
+class APIError(Exception):
+    def __init__(self, response):
+        self.status_code = response.status_code
+        self.text = response.text
+        super().__init__(f'{response.status_code} {response.reason}: {response.text[:200]}')
+
+class RateLimiter():
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+class ResponseCache():
+    def __init__(self, cache_file, max_size=64 * 1024 * 1024):
+        self.cache_file = cache_file
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'r') as file:
+                entries = json.load(file)
+        except ValueError:
+            return
+        now = time.time()
+        for key, expires_at, text in entries:
+            if expires_at > now:
+                self.entries[key] = (expires_at, text)
+                self.size += len(text)
+        self.evict()
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            entries = [[key, expires_at, text] for key, (expires_at, text) in self.entries.items()]
+            self.dirty = False
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        tmp_file = f'{self.cache_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as file:
+            json.dump(entries, file)
+        os.replace(tmp_file, self.cache_file)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, text = entry
+            if expires_at <= time.time():
+                self.remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return text
+
+    def set(self, key, text, ttl):
+        if ttl <= 0 or len(text) > self.max_size:
+            return
+        with self.lock:
+            self.remove(key)
+            self.entries[key] = (time.time() + ttl, text)
+            self.size += len(text)
+            self.dirty = True
+            self.evict()
+
+    def evict(self):
+        while self.size > self.max_size:
+            _, (_, text) = self.entries.popitem(last=False)
+            self.size -= len(text)
+            self.dirty = True
+
+    def invalidate(self, prefix):
+        with self.lock:
+            for key in [key for key in self.entries if key.startswith(prefix)]:
+                self.remove(key)
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+            self.dirty = True
+
+class CassetteMiss(Exception):
+    pass
+
+class Cassette():
+    def __init__(self, path, replay=False):
+        self.path = path
+        self.replaying = replay
+        self.lock = threading.Lock()
+        self.bodies = {}
+        self.interactions = []
+        self.queues = {}
+        if replay:
+            self.load()
+
+    def body_key(self, data):
+        if data is None:
+            return None
+        if isinstance(data, dict):
+            data = json.dumps(data, sort_keys=True)
+        if isinstance(data, str):
+            data = data.encode()
+        return hashlib.sha1(data).hexdigest()[:16]
+
+    def path_of(self, url):
+        url = urlparse(url)
+        return f'{url.path}?{url.query}' if url.query else url.path
+
+    def load(self):
+        import gzip
+        with gzip.open(self.path, 'rt') as file:
+            cassette = json.load(file)
+        self.bodies = cassette['bodies']
+        self.interactions = cassette['interactions']
+        for interaction in self.interactions:
+            path = self.path_of(interaction['url'])
+            for key in ((interaction['method'], path, interaction['request']),
+                        (interaction['method'], path)):
+                self.queues.setdefault(key, deque()).append(interaction)
+
+    def save(self):
+        import gzip
+        with self.lock:
+            cassette = {'version': 1, 'bodies': self.bodies, 'interactions': self.interactions}
+            tmp_file = f'{self.path}.{os.getpid()}.tmp'
+            with gzip.open(tmp_file, 'wt') as file:
+                json.dump(cassette, file, separators=(',', ':'))
+            os.replace(tmp_file, self.path)
+
+    def record(self, method, url, data, response):
+        body = response.content
+        key = hashlib.sha1(body).hexdigest()[:16]
+        with self.lock:
+            if key not in self.bodies:
+                self.bodies[key] = body.decode('utf-8', errors='replace')
+            self.interactions.append({
+                'method': method,
+                'url': url,
+                'request': self.body_key(data),
+                'status': response.status_code,
+                'reason': response.reason,
+                'content_type': response.headers.get('Content-Type'),
+                'body': key,
+            })
+
+    def replay(self, method, url, data):
+        with self.lock:
+            path = self.path_of(url)
+            queue = (self.queues.get((method, path, self.body_key(data)))
+                     or self.queues.get((method, path)))
+            if not queue:
+                raise CassetteMiss(f'no recorded response for {method} {url}')
+            interaction = queue[0] if len(queue) == 1 else queue.popleft()
+        from requests import Response
+        response = Response()
+        response.status_code = interaction['status']
+        response.reason = interaction['reason']
+        response.url = url
+        response.encoding = 'utf-8'
+        response.headers['Content-Type'] = interaction['content_type'] or 'application/json'
+        response._content = self.bodies[interaction['body']].encode()
+        response._content_consumed = True
+        return response
+
 class API():
-    def __init__(self, server=None):
+    def __init__(self, server=None, pool_size=10, connect_timeout=5, read_timeout=60,
+                 use_cache=True, refresh_cache=False, cache_size=64, timings=None,
+                 cassette=None):
         self.server = server
+        self.cassette = cassette
+        self.quiet = False
+        self.ndjson = False
+        self.cached = False
+        self.verbose = False
+        self.timings = timings
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_size = pool_size
+        self.session = None
+        self.session_lock = threading.Lock()
+        self.base_headers = {
+           'Accept': '*/*',
+           'Host': self.server,
+           'Connection': 'keep-alive',
+        }
+        self.headers = self.base_headers
         self.token_file = 'data/token.json'
-        self.token = self.load_token()
-        if not self.token or self.is_token_expired(self.token):
-            self.token = self.create_token()
-            self.save_token(self.token)
-        self.token_id = self.token.get('id')
+        self.token_lock = threading.Lock()
+        self.token_refresher = None
+        self.closing = threading.Event()
+        self.cache = None
+        self.refresh_cache = refresh_cache
+        if use_cache:
+            cache_file = os.path.join(os.path.dirname(self.token_file), 'cache.json')
+            self.cache = ResponseCache(cache_file, max_size=cache_size * 1024 * 1024)
+        if cassette and cassette.replaying:
+            self.set_token({'id': 'replay', 'expires_at': float('inf')})
+        else:
+            self.set_token(self.load_token())
+        self.ensure_token()
+
+    def create_session(self, pool_size):
+        import requests
+        session = requests.Session()
+        adapter = timed_adapter_class()(pool_connections=pool_size,
+                                        pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def get_session(self):
+        if self.session is None:
+            with self.session_lock:
+                if self.session is None:
+                    self.session = self.create_session(self.pool_size)
+        return self.session
+
+    def url(self, path):
+        return f"http://{self.server}/api/v1{path}"
+
+    def clone(self):
+        api = copy.copy(self)
+        api.quiet = False
+        api.ndjson = False
+        api.cached = False
+        api.verbose = False
+        api.timings = None
+        return api
+
+    def close(self):
+        self.closing.set()
+        if self.cache:
+            self.cache.save()
+        if self.cassette and not self.cassette.replaying:
+            self.cassette.save()
+        if self.session:
+            self.session.close()
+
+    def request(self, method, url, data=None, headers=None, stream=False, auth=True):
+        if auth:
+            self.ensure_token()
+            request_headers = self.headers
+        else:
+            request_headers = self.base_headers
+        if headers:
+            request_headers = dict(request_headers, **headers)
+        if method != 'GET' and self.cache:
+            match = re.match(r'.*?/platforms/[^/]+', url)
+            self.cache.invalidate(match.group(0) if match else url)
+        if self.cassette and self.cassette.replaying:
+            response = self.cassette.replay(method, url, data)
+        elif self.timings is None:
+            response = self.get_session().request(method, url, headers=request_headers, data=data,
+                                                  timeout=self.timeout, stream=stream)
+        else:
+            response = self.timed_request(method, url, request_headers, data, stream)
+        if self.cassette and not self.cassette.replaying:
+            self.cassette.record(method, url, data, response)
+        if self.quiet and not response.ok:
+            raise APIError(response)
+        return response
+
+    def timed_request(self, method, url, headers, data, stream):
+        session = self.get_session()
+        request_timing.connect = 0.0
+        start = time.perf_counter()
+        response = None
+        try:
+            response = session.request(method, url, headers=headers, data=data,
+                                       timeout=self.timeout, stream=stream)
+            return response
+        finally:
+            total = time.perf_counter() - start
+            if response is None:
+                self.timings.record(method, url, None, request_timing.connect, total, total, 0)
+            else:
+                if stream:
+                    size = int(response.headers.get('Content-Length') or 0)
+                else:
+                    size = len(response.content)
+                self.timings.record(method, url, response.status_code, request_timing.connect,
+                                    response.elapsed.total_seconds(), total, size)
+
+    def get_text(self, url, data=None, use_cache=True):
+        key = f'{url} {data or ""}'
+        use_cache = use_cache and self.cache is not None
+        if use_cache and not self.refresh_cache:
+            text = self.cache.get(key)
+            if text is not None:
+                return text
+        response = self.request("GET", url, data=data)
+        if use_cache and response.ok:
+            self.cache.set(key, response.text, cache_ttl(url))
+        return response.text
+
+    def stream_get(self, url, data=None):
+        text = None
+        if self.cache is not None and not self.refresh_cache:
+            text = self.cache.get(f'{url} {data or ""}')
+        if text is not None:
+            records = iter_json_records([text])
+        else:
+            response = self.request("GET", url, data=data, stream=True)
+            records = iter_json_records(iter_response_text(response))
+        for record in records:
+            write_json_line(record)
 
     def is_cached(self):
-        cached = os.getenv('CACHED')
-        if cached in ('TRUE', 'true', 'YES', 'yes', 'ON', 'on', 1):
-            return True
-        return False
+        return self.cached or env_enabled('CACHED')
 
     def is_verbose(self):
-        cached = os.getenv('VERBOSE')
-        if cached in ('TRUE', 'true', 'YES', 'yes', 'ON', 'on', 1):
-            return True
-        return False
+        return self.verbose or env_enabled('VERBOSE')
+
+    def output(self, text):
+        if not self.quiet:
+            print(text)
+        return text
 
     def print_request(self, url, headers, data=None):
-        if self.is_verbose():
+        if self.is_verbose() and not self.quiet:
             print(f"URL: {url}")
             print(f"HEADERS: {headers}")
             print(f"REQUEST BODY: {data}")
 
-    def is_token_expired(self, token):
-        created_at = token.get('created_at')
-        ttl = token.get('ttl')
-        created_at = datetime.datetime.strptime(created_at, "%Y-%m-%d %H:%M:%S.%f")
-        created_at = created_at.replace(tzinfo=datetime.timezone.utc)
-        expiration_time = created_at + datetime.timedelta(seconds=ttl-5)
-        current_time = datetime.datetime.now(datetime.timezone.utc)
-        return current_time > expiration_time
+    def token_expiry(self, token):
+        if 'expires_at' not in token:
+            created_at = datetime.datetime.strptime(token.get('created_at'), "%Y-%m-%d %H:%M:%S.%f")
+            created_at = created_at.replace(tzinfo=datetime.timezone.utc)
+            token['expires_at'] = created_at.timestamp() + token.get('ttl') - 5
+        return token['expires_at']
+
+    def is_token_expired(self, token, margin=0):
+        return time.time() + margin >= self.token_expiry(token)
+
+    def set_token(self, token):
+        self.token = token
+        self.token_id = token.get('id') if token else None
+        self.token_expires_at = self.token_expiry(token) if token else 0
+        self.headers = dict(self.base_headers, Authorization=self.token_id)
+
+    def ensure_token(self):
+        if time.time() >= self.token_expires_at:
+            self.refresh_token()
+
+    def refresh_token(self, margin=0):
+        with self.token_lock:
+            if time.time() + margin < self.token_expires_at:
+                return
+            with self.token_file_lock():
+                token = self.load_token()
+                if not token or self.is_token_expired(token, margin):
+                    token = self.create_token()
+                    self.save_token(token)
+            self.set_token(token)
+
+    @contextmanager
+    def token_file_lock(self):
+        os.makedirs(os.path.dirname(self.token_file), exist_ok=True)
+        with open(f'{self.token_file}.lock', 'w') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def start_token_refresher(self, margin=60):
+        if self.token_refresher:
+            return
+        def refresh():
+            while not self.closing.wait(min(3600, max(1, self.token_expires_at - margin - time.time()))):
+                try:
+                    self.refresh_token(margin)
+                except Exception:
+                    self.closing.wait(5)
+        self.token_refresher = threading.Thread(target=refresh, name='token-refresher', daemon=True)
+        self.token_refresher.start()
 
     def load_token(self):
         if os.path.exists(self.token_file):
-            with open(self.token_file, 'r') as file:
-                data = json.load(file)
-                return data.get('token')
+            try:
+                with open(self.token_file, 'r') as file:
+                    data = json.load(file)
+            except ValueError:
+                return None
+            token = data.get('token')
+            if token:
+                self.token_expiry(token)
+            return token
         return None
 
     def save_token(self, token):
         os.makedirs(os.path.dirname(self.token_file), exist_ok=True)
-        with open(self.token_file, 'w') as file:
+        tmp_file = f'{self.token_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as file:
             json.dump({'token': token}, file)
+        os.replace(tmp_file, self.token_file)
 
     def do_get(self, url, payload=None):
         if not payload:
             payload = dict()
         payload['cached'] = True if self.is_cached() else False
         data = json.dumps(payload)
-        headers = {
-           'Authorization': self.token_id,
-           'Accept': '*/*',
-           'Host': self.server,
-           'Connection': 'keep-alive',
-        }
-        self.print_request(url, headers, data)
-        response = requests.request("GET", url, headers=headers, data=data)
-        if self.is_verbose():
+        self.print_request(url, self.headers, data)
+        if self.ndjson and not self.quiet:
+            return self.stream_get(url, data=data)
+        text = self.get_text(url, data=data)
+        if self.is_verbose() and not self.quiet:
             try:
-                pprint_data = json.loads(response.text)
+                pprint_data = json.loads(text)
                 from pprint import pprint
                 pprint(pprint_data)
             except Exception:
-                print(response.text)
-        else:
-            print(response.text)
+                return self.output(text)
+            return text
+        return self.output(text)
 
-    def do_post(self, url, json_file=None):
-        if not json_file:
+    def do_post(self, url, json_file=None, payload=None):
+        if payload is not None:
+            data = json.dumps(payload)
+        elif not json_file:
             data = {}
         else:
             with open(json_file, 'r') as ff:
                 payload = json.load(ff)
             data = json.dumps(payload)
 
-        headers = {
-           'Authorization': self.token_id,
-           'Content-Type': 'application/json',
-           'Accept': '*/*',
-           'Host': self.server,
-           'Connection': 'keep-alive',
-        }
-        self.print_request(url, headers, data)
-        response = requests.request("POST", url, headers=headers, data=data)
-        print(response.text)
+        headers = {'Content-Type': 'application/json'}
+        self.print_request(url, dict(self.headers, **headers), data)
+        response = self.request("POST", url, data=data, headers=headers)
+        return self.output(response.text)
 
     def do_patch(self, url, json_file):
         with open(json_file, 'r') as ff:
             payload = json.load(ff)
         data = json.dumps(payload)
-        headers = {
-           'Authorization': self.token_id,
-           'Accept': '*/*',
-           'Host': self.server,
-           'Connection': 'keep-alive',
-        }
-        self.print_request(url, headers, data)
-        response = requests.request("PATCH", url, headers=headers, data=data)
-        print(response.text)
+        self.print_request(url, self.headers, data)
+        response = self.request("PATCH", url, data=data)
+        return self.output(response.text)
 
     def do_delete(self, url):
-        headers = {
-           'Authorization': self.token_id,
-           'Accept': '*/*',
-           'Host': self.server,
-           'Connection': 'keep-alive',
-        }
-        self.print_request(url, headers)
-        response = requests.request("DELETE", url, headers=headers)
-        print(response.text)
+        self.print_request(url, self.headers)
+        response = self.request("DELETE", url)
+        return self.output(response.text)
 
 
     def create_token(self):
-        url = f"http://{self.server}/api/v1/tokens"
+        url = self.url('/tokens')
         payload = json.dumps({
            "email": "cloud@astute-tec.com"
         })
-        headers = {
-           'Content-Type': 'application/json',
-           'Accept': '*/*',
-           'Host': self.server,
-           'Connection': 'keep-alive'
-        }
-        response = requests.request("POST", url, headers=headers, data=payload)
+        headers = {'Content-Type': 'application/json'}
+        response = self.request("POST", url, data=payload, headers=headers, auth=False)
         data = json.loads(response.content)
         token = {}
         token['id'] = data.get('token')
         token['created_at'] = data.get('created_at')
         token['ttl'] = data.get('ttl')
+        self.token_expiry(token)
         return token
 
     def do_list_tokens(self):
-        url = f"http://{self.server}/api/v1/tokens"
-        payload = json.dumps(
-            {
-                "email":"cloud@astute-tec.com"
-            })
-        self.do_get(url, payload=payload)
+        url = self.url('/tokens')
+        payload = {
+            "email":"cloud@astute-tec.com"
+        }
+        return self.do_get(url, payload=payload)
 
     def do_add_platform(self, json_file):
-        url = f"http://{self.server}/api/v1/platforms"
+        url = self.url('/platforms')
         with open(json_file, 'r') as ff:
             data = json.load(ff)
         payload = json.dumps(data)
-        headers = {
-           'Authorization': self.token_id,
-           'Accept': '*/*',
-           'Host': self.server,
-           'Connection': 'keep-alive',
-        }
-        response = requests.request("POST", url, headers=headers, data=payload)
-        print(response.text)
-
-    def do_update_platform(self, json_file):
-        url = f"http://{self.server}/api/v1/platforms"
-        self.do_patch(url, json_file)
+        response = self.request("POST", url, data=payload)
+        return self.output(response.text)
 
     def do_ping_platform(self, platform_id):
-        url = f"http://{self.server}/api/v1/platform/ping"
+        url = self.url('/platform/ping')
         payload = {
             "platform_id": platform_id
         }
-        headers = {
-           'Authorization': self.token_id,
-           'Accept': '*/*',
-           'Host': self.server,
-           'Connection': 'keep-alive',
-        }
-        response = requests.request("POST", url, headers=headers, data=payload)
-        print(response.text)
-
-    def do_delete_platform(self, platform_id):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}"
-        self.do_delete(url)
+        response = self.request("POST", url, data=payload)
+        return self.output(response.text)
 
     def do_list_platforms(self):
-        url = f"http://{self.server}/api/v1/platforms"
-        headers = {
-           'Authorization': self.token_id,
-           'Accept': '*/*',
-           'Host': self.server,
-           'Connection': 'keep-alive',
-        }
-        response = requests.request("GET", url, headers=headers)
-        print(response.text)
-
-
-
-    def do_list_clouds(self, platform_id):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/clouds"
-        self.do_get(url)
-    
-    def do_list_volume_types(self, platform_id):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/volume_types"
-        self.do_get(url)
-
-    def do_list_images(self, platform_id):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/images"
-        self.do_get(url)
-
-    def do_get_image(self, platform_id, image_id):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/images/{image_id}"
-        self.do_get(url)
-
-    def do_list_sizes(self, platform_id):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/sizes"
-        self.do_get(url)
-
-    def do_get_size(self, platform_id, size_id):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/sizes/{size_id}"
-        self.do_get(url)
-
-    def do_list_templates(self, platform_id):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/templates"
-        self.do_get(url)
-
-    def do_get_template(self, platform_id, template_id):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/templates/{template_id}"
-        self.do_get(url)
-
-    def do_list_pf_networks(self, platform_id):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/networks"
-        self.do_get(url)
-
-    def do_list_clusters(self, platform_id):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/clusters"
-        self.do_get(url)
-
-    def do_list_hosts(self, platform_id, cluster_id):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/clusters/{cluster_id}/hosts"
-        self.do_get(url)
-
-    def do_list_machines(self, platform_id, cloud_id):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/clouds/{cloud_id}/machines"
-        self.do_get(url)
-
-    def do_create_machine(self, platform_id, cloud_id, json_file):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/clouds/{cloud_id}/machines"
-        self.do_post(url, json_file)
-
-    def do_create_machine_from_template(self, platform_id, cloud_id, json_file):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/clouds/{cloud_id}/machines_from_template"
-        self.do_post(url, json_file)
-
-    def do_get_machine(self, platform_id, cloud_id, machine_id):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/clouds/{cloud_id}/machines/{machine_id}"
-        self.do_get(url)
-
-    def do_get_machine_console(self, platform_id, cloud_id, machine_id):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/clouds/{cloud_id}/machines/{machine_id}/console"
-        self.do_get(url)
-
-    def do_list_volumes(self, platform_id, cloud_id):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/clouds/{cloud_id}/volumes"
-        self.do_get(url)
-
-    def do_get_volume(self, platform_id, cloud_id, volume_id):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/clouds/{cloud_id}/volumes/{volume_id}"
-        self.do_get(url)
-
-    def do_list_networks(self, platform_id, cloud_id):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/clouds/{cloud_id}/networks"
-        self.do_get(url)
-
-    def do_get_network(self, platform_id, cloud_id, network_id):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/clouds/{cloud_id}/networks/{network_id}"
-        self.do_get(url)
-
-    def do_machine_action(self, platform_id, cloud_id, machine_id, json_file):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/clouds/{cloud_id}/machines/{machine_id}"
-        self.do_post(url, json_file)
-
-    def do_template_action(self, platform_id, template_id, json_file):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/templates/{template_id}/action"
-        self.do_post(url, json_file)
-
-    def do_delete_machine(self, platform_id, cloud_id, machine_id):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/clouds/{cloud_id}/machines/{machine_id}"
-        self.do_delete(url)
-
-    def do_delete_template(self, platform_id, template_id):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/templates/{template_id}"
-        self.do_delete(url)
-
-    def do_list_security_groups(self, platform_id, cloud_id):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/clouds/{cloud_id}/security-groups"
-        self.do_get(url)
-
-    def do_sync_volume_type(self, platform_id):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/volume_type/sync"
-        self.do_post(url)
-
-    def do_sync_cloud(self, platform_id):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/cloud/sync"
-        self.do_post(url)
-
-    def do_sync_cluster(self, platform_id):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/cluster/sync"
-        self.do_post(url)
-
-    def do_sync_image(self, platform_id):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/image/sync"
-        self.do_post(url)
-
-    def do_sync_host(self, platform_id, json_file):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/host/sync"
-        self.do_post(url, json_file)
-
-    def do_sync_machine(self, platform_id, json_file):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/machine/sync"
-        self.do_post(url, json_file)
-
-    def do_sync_pf_network(self, platform_id):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/network/sync"
-        self.do_post(url)
-
-    def do_sync_network(self, platform_id, json_file):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/network/sync"
-        self.do_post(url, json_file=json_file)
-
-    def do_sync_volume(self, platform_id, json_file):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/volume/sync"
-        self.do_post(url, json_file)
-
-    def do_sync_template(self, platform_id):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/template/sync"
-        self.do_post(url)
-
-    def do_poll_image(self, platform_id, json_file):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/image/update_poller"
-        self.do_post(url, json_file)
-
-    def do_poll_template(self, platform_id, json_file):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/template/update_poller"
-        self.do_post(url, json_file)
-
-    def do_poll_host(self, platform_id, cluster_id, json_file):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/clusters/{cluster_id}/update_poller"
-        self.do_post(url, json_file)
-
-    def do_poll_machine(self, platform_id, cloud_id, json_file):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/clouds/{cloud_id}/update_poller"
-        self.do_post(url, json_file)
-
-    def do_poll_volume(self, platform_id, cloud_id, json_file):
-        url = f"http://{self.server}/api/v1/platforms/{platform_id}/clouds/{cloud_id}/update_volume_poller"
-        self.do_post(url, json_file)
-
-
-def parse_argument():
-    parser = argparse.ArgumentParser()
+        url = self.url('/platforms')
+        return self.output(self.get_text(url))
+
+    def fetch_template(self, platform_id, template_id):
+        url = self.url(f'/platforms/{platform_id}/templates/{template_id}')
+        return json.loads(self.get_text(url, data=json.dumps({'cached': False}), use_cache=False))
+
+    def fetch_machine(self, platform_id, cloud_id, machine_id):
+        url = self.url(f'/platforms/{platform_id}/clouds/{cloud_id}/machines/{machine_id}')
+        return json.loads(self.get_text(url, data=json.dumps({'cached': False}), use_cache=False))
+
+Endpoint = namedtuple('Endpoint', ['method', 'path', 'args', 'wait'], defaults=(False,))
+
+ENDPOINTS = {
+    'list-platforms': Endpoint('GET', '/platforms', ()),
+    'list-tokens': Endpoint('GET', '/tokens', ()),
+    'add-platform': Endpoint('POST', '/platforms', ('json_file',)),
+    'update-platform': Endpoint('PATCH', '/platforms', ('json_file',)),
+    'ping-platform': Endpoint('POST', '/platform/ping', ('platform_id',)),
+    'delete-platform': Endpoint('DELETE', '/platforms/{platform_id}', ('platform_id',)),
+    'list-clouds': Endpoint('GET', '/platforms/{platform_id}/clouds', ('platform_id',)),
+    'list-images': Endpoint('GET', '/platforms/{platform_id}/images', ('platform_id',)),
+    'list-sizes': Endpoint('GET', '/platforms/{platform_id}/sizes', ('platform_id',)),
+    'get-size': Endpoint('GET', '/platforms/{platform_id}/sizes/{size_id}',
+                         ('platform_id', 'size_id')),
+    'get-image': Endpoint('GET', '/platforms/{platform_id}/images/{image_id}',
+                          ('platform_id', 'image_id')),
+    'list-templates': Endpoint('GET', '/platforms/{platform_id}/templates', ('platform_id',)),
+    'get-template': Endpoint('GET', '/platforms/{platform_id}/templates/{template_id}',
+                             ('platform_id', 'template_id')),
+    'list-clusters': Endpoint('GET', '/platforms/{platform_id}/clusters', ('platform_id',)),
+    'list-hosts': Endpoint('GET', '/platforms/{platform_id}/clusters/{cluster_id}/hosts',
+                           ('platform_id', 'cluster_id')),
+    'list-machines': Endpoint('GET', '/platforms/{platform_id}/clouds/{cloud_id}/machines',
+                              ('platform_id', 'cloud_id')),
+    'create-machine': Endpoint('POST', '/platforms/{platform_id}/clouds/{cloud_id}/machines',
+                               ('platform_id', 'cloud_id', 'json_file'), wait=True),
+    'create-machine-from-template': Endpoint(
+        'POST', '/platforms/{platform_id}/clouds/{cloud_id}/machines_from_template',
+        ('platform_id', 'cloud_id', 'json_file'), wait=True),
+    'get-machine': Endpoint('GET', '/platforms/{platform_id}/clouds/{cloud_id}/machines/{machine_id}',
+                            ('platform_id', 'cloud_id', 'machine_id')),
+    'get-machine-console': Endpoint(
+        'GET', '/platforms/{platform_id}/clouds/{cloud_id}/machines/{machine_id}/console',
+        ('platform_id', 'cloud_id', 'machine_id')),
+    'delete-machine': Endpoint('DELETE', '/platforms/{platform_id}/clouds/{cloud_id}/machines/{machine_id}',
+                               ('platform_id', 'cloud_id', 'machine_id')),
+    'delete-template': Endpoint('DELETE', '/platforms/{platform_id}/templates/{template_id}',
+                                ('platform_id', 'template_id')),
+    'list-volume-types': Endpoint('GET', '/platforms/{platform_id}/volume_types', ('platform_id',)),
+    'list-pf-networks': Endpoint('GET', '/platforms/{platform_id}/networks', ('platform_id',)),
+    'list-volumes': Endpoint('GET', '/platforms/{platform_id}/clouds/{cloud_id}/volumes',
+                             ('platform_id', 'cloud_id')),
+    'get-volume': Endpoint('GET', '/platforms/{platform_id}/clouds/{cloud_id}/volumes/{volume_id}',
+                           ('platform_id', 'cloud_id', 'volume_id')),
+    'list-networks': Endpoint('GET', '/platforms/{platform_id}/clouds/{cloud_id}/networks',
+                              ('platform_id', 'cloud_id')),
+    'get-network': Endpoint('GET', '/platforms/{platform_id}/clouds/{cloud_id}/networks/{network_id}',
+                            ('platform_id', 'cloud_id', 'network_id')),
+    'machine-action': Endpoint('POST', '/platforms/{platform_id}/clouds/{cloud_id}/machines/{machine_id}',
+                               ('platform_id', 'cloud_id', 'machine_id', 'json_file'), wait=True),
+    'list-security-groups': Endpoint('GET', '/platforms/{platform_id}/clouds/{cloud_id}/security-groups',
+                                     ('platform_id', 'cloud_id')),
+    'sync-volume-type': Endpoint('POST', '/platforms/{platform_id}/volume_type/sync', ('platform_id',)),
+    'sync-cloud': Endpoint('POST', '/platforms/{platform_id}/cloud/sync', ('platform_id',)),
+    'sync-cluster': Endpoint('POST', '/platforms/{platform_id}/cluster/sync', ('platform_id',)),
+    'sync-image': Endpoint('POST', '/platforms/{platform_id}/image/sync', ('platform_id',)),
+    'sync-host': Endpoint('POST', '/platforms/{platform_id}/host/sync', ('platform_id', 'json_file')),
+    'sync-machine': Endpoint('POST', '/platforms/{platform_id}/machine/sync', ('platform_id', 'json_file')),
+    'sync-pf-network': Endpoint('POST', '/platforms/{platform_id}/network/sync', ('platform_id',)),
+    'sync-network': Endpoint('POST', '/platforms/{platform_id}/network/sync', ('platform_id', 'json_file')),
+    'sync-volume': Endpoint('POST', '/platforms/{platform_id}/volume/sync', ('platform_id', 'json_file')),
+    'sync-template': Endpoint('POST', '/platforms/{platform_id}/template/sync', ('platform_id',)),
+    'poll-image': Endpoint('POST', '/platforms/{platform_id}/image/update_poller',
+                           ('platform_id', 'json_file')),
+    'poll-template': Endpoint('POST', '/platforms/{platform_id}/template/update_poller',
+                              ('platform_id', 'json_file')),
+    'poll-host': Endpoint('POST', '/platforms/{platform_id}/clusters/{cluster_id}/update_poller',
+                          ('platform_id', 'cluster_id', 'json_file')),
+    'poll-machine': Endpoint('POST', '/platforms/{platform_id}/clouds/{cloud_id}/update_poller',
+                             ('platform_id', 'cloud_id', 'json_file')),
+    'poll-volume': Endpoint('POST', '/platforms/{platform_id}/clouds/{cloud_id}/update_volume_poller',
+                            ('platform_id', 'cloud_id', 'json_file')),
+    'template-action': Endpoint('POST', '/platforms/{platform_id}/templates/{template_id}/action',
+                                ('platform_id', 'template_id', 'json_file'), wait=True),
+}
+
+def command_method(subcommand):
+    return f"do_{subcommand.replace('-', '_')}"
+
+def endpoint_method(endpoint):
+    def method(self, *call_args, payload=None):
+        values = dict(zip(endpoint.args, call_args))
+        url = self.url(endpoint.path.format(**values))
+        if endpoint.method == 'GET':
+            return self.do_get(url)
+        if endpoint.method == 'DELETE':
+            return self.do_delete(url)
+        if endpoint.method == 'PATCH':
+            return self.do_patch(url, values['json_file'])
+        return self.do_post(url, values.get('json_file'), payload=payload)
+    return method
+
+for subcommand, endpoint in ENDPOINTS.items():
+    if not hasattr(API, command_method(subcommand)):
+        setattr(API, command_method(subcommand), endpoint_method(endpoint))
+
+def add_wait_arguments(parser, flag=False):
+    if flag:
+        parser.add_argument('--wait', action='store_true',
+                            help="Wait for the resource to reach the target state")
+    parser.add_argument('--state', action='append', default=[],
+                        help="Target state, may be repeated(default:derived from the action)")
+    parser.add_argument('--not-state', action='append', default=[],
+                        help="Wait until the state is none of these, may be repeated")
+    parser.add_argument('--timeout', type=float, default=600,
+                        help="Seconds to wait before giving up(default:600)")
+    parser.add_argument('--interval', type=float, default=1,
+                        help="Initial seconds between polls(default:1)")
+    parser.add_argument('--max-interval', type=float, default=30,
+                        help="Max seconds between polls(default:30)")
+
+def add_global_arguments(parser):
     parser.add_argument('-s', '--server', action='store', dest='server')
     parser.add_argument('-c', '--cached', action='store_true', help="Fetch data in cached mode(default:False)")
     parser.add_argument('-v', '--verbose', action='store_true')
-    subparsers = parser.add_subparsers(dest='subcommand', required=True)
-
-    parser_list_platforms = subparsers.add_parser('list-platforms')
-
-    parser_list_tokens = subparsers.add_parser('list-tokens')
-
-    parser_add_platform = subparsers.add_parser('add-platform')
-    parser_add_platform.add_argument('json_file')
-
-    parser_update_platform = subparsers.add_parser('update-platform')
-    parser_update_platform.add_argument('json_file')
-
-    parser_ping_platform = subparsers.add_parser('ping-platform')
-    parser_ping_platform.add_argument('platform_id')
-
-    parser_delete_platform = subparsers.add_parser('delete-platform')
-    parser_delete_platform.add_argument('platform_id')
-
-    parser_list_clouds = subparsers.add_parser('list-clouds')
-    parser_list_clouds.add_argument('platform_id')
-
-    parser_list_images = subparsers.add_parser('list-images')
-    parser_list_images.add_argument('platform_id')
-
-    parser_list_sizes = subparsers.add_parser('list-sizes')
-    parser_list_sizes.add_argument('platform_id')
-
-    parser_get_size = subparsers.add_parser('get-size')
-    parser_get_size.add_argument('platform_id')
-    parser_get_size.add_argument('size_id')
-
-    parser_get_image = subparsers.add_parser('get-image')
-    parser_get_image.add_argument('platform_id')
-    parser_get_image.add_argument('image_id')
-
-    parser_list_templates = subparsers.add_parser('list-templates')
-    parser_list_templates.add_argument('platform_id')
-
-    parser_get_template = subparsers.add_parser('get-template')
-    parser_get_template.add_argument('platform_id')
-    parser_get_template.add_argument('template_id')
-
-    parser_list_clusters = subparsers.add_parser('list-clusters')
-    parser_list_clusters.add_argument('platform_id')
-
-    parser_list_hosts = subparsers.add_parser('list-hosts')
-    parser_list_hosts.add_argument('platform_id')
-    parser_list_hosts.add_argument('cluster_id')
-
-    parser_list_machines = subparsers.add_parser('list-machines')
-    parser_list_machines.add_argument('platform_id')
-    parser_list_machines.add_argument('cloud_id')
-
-    parser_create_machine = subparsers.add_parser('create-machine')
-    parser_create_machine.add_argument('platform_id')
-    parser_create_machine.add_argument('cloud_id')
-    parser_create_machine.add_argument('json_file')
-
-    parser_create_machine_from_templ = subparsers.add_parser('create-machine-from-template')
-    parser_create_machine_from_templ.add_argument('platform_id')
-    parser_create_machine_from_templ.add_argument('cloud_id')
-    parser_create_machine_from_templ.add_argument('json_file')
-
-    parser_get_machine = subparsers.add_parser('get-machine')
-    parser_get_machine.add_argument('platform_id')
-    parser_get_machine.add_argument('cloud_id')
-    parser_get_machine.add_argument('machine_id')
-
-    parser_get_machine_console = subparsers.add_parser('get-machine-console')
-    parser_get_machine_console.add_argument('platform_id')
-    parser_get_machine_console.add_argument('cloud_id')
-    parser_get_machine_console.add_argument('machine_id')
-
-    parser_delete_machine = subparsers.add_parser('delete-machine')
-    parser_delete_machine.add_argument('platform_id')
-    parser_delete_machine.add_argument('cloud_id')
-    parser_delete_machine.add_argument('machine_id')
-
-    parser_delete_template = subparsers.add_parser('delete-template')
-    parser_delete_template.add_argument('platform_id')
-    parser_delete_template.add_argument('template_id')
-
-    parser_list_volume_types = subparsers.add_parser('list-volume-types')
-    parser_list_volume_types.add_argument('platform_id')
-
-    parser_list_pf_networks = subparsers.add_parser('list-pf-networks')
-    parser_list_pf_networks.add_argument('platform_id')
-
-    parser_list_volumes = subparsers.add_parser('list-volumes')
-    parser_list_volumes.add_argument('platform_id')
-    parser_list_volumes.add_argument('cloud_id')
-
-    parser_get_volume = subparsers.add_parser('get-volume')
-    parser_get_volume.add_argument('platform_id')
-    parser_get_volume.add_argument('cloud_id')
-    parser_get_volume.add_argument('volume_id')
-
-    parser_list_networks = subparsers.add_parser('list-networks')
-    parser_list_networks.add_argument('platform_id')
-    parser_list_networks.add_argument('cloud_id')
-
-    parser_get_network = subparsers.add_parser('get-network')
-    parser_get_network.add_argument('platform_id')
-    parser_get_network.add_argument('cloud_id')
-    parser_get_network.add_argument('network_id')
-
-    parser_machine_action = subparsers.add_parser('machine-action')
-    parser_machine_action.add_argument('platform_id')
-    parser_machine_action.add_argument('cloud_id')
-    parser_machine_action.add_argument('machine_id')
-    parser_machine_action.add_argument('json_file')
-
-    parser_list_sgs = subparsers.add_parser('list-security-groups')
-    parser_list_sgs.add_argument('platform_id')
-    parser_list_sgs.add_argument('cloud_id')
-
-    parser_sync_volume_type = subparsers.add_parser('sync-volume-type')
-    parser_sync_volume_type.add_argument('platform_id')
-
-    parser_sync_cloud = subparsers.add_parser('sync-cloud')
-    parser_sync_cloud.add_argument('platform_id')
-
-    parser_sync_cluster = subparsers.add_parser('sync-cluster')
-    parser_sync_cluster.add_argument('platform_id')
-
-    parser_sync_image = subparsers.add_parser('sync-image')
-    parser_sync_image.add_argument('platform_id')
+    parser.add_argument('--pool-size', type=int, default=10,
+                        help="Max pooled keep-alive connections(default:10)")
+    parser.add_argument('--connect-timeout', type=float, default=5,
+                        help="Seconds to wait for a connection(default:5)")
+    parser.add_argument('--read-timeout', type=float, default=60,
+                        help="Seconds to wait for a response(default:60)")
+    parser.add_argument('--ndjson', action='store_true',
+                        help="Stream list responses as one JSON object per line")
+    parser.add_argument('--timings', action='store_true',
+                        help="Print per-endpoint request timings to stderr on exit")
+    parser.add_argument('--timings-export',
+                        help="Write per-endpoint request timings to this file on exit")
+    parser.add_argument('--timings-format', choices=('json', 'prometheus'), default='json',
+                        help="Format of --timings-export(default:json)")
+    cassette_group = parser.add_mutually_exclusive_group()
+    cassette_group.add_argument('--record', metavar='FILE',
+                                help="Record every request and response to a compressed cassette")
+    cassette_group.add_argument('--replay', metavar='FILE',
+                                help="Serve responses from a recorded cassette without network access")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Do not use the local response cache")
+    parser.add_argument('--refresh', action='store_true',
+                        help="Ignore cached responses but store fresh ones")
+    parser.add_argument('--cache-size', type=int, default=64,
+                        help="Max size of the local response cache in MB(default:64)")
+    parser.add_argument('--no-daemon', action='store_true',
+                        help="Run in this process even when a serve daemon is listening")
+
+def add_endpoint_arguments(parser, endpoint):
+    for name in endpoint.args:
+        parser.add_argument(name)
+    if endpoint.wait:
+        add_wait_arguments(parser, flag=True)
+
+@contextmanager
+def silence_stderr():
+    if isinstance(sys.stderr, ThreadLocalStream):
+        with sys.stderr.redirect(io.StringIO()):
+            yield
+    else:
+        with redirect_stderr(io.StringIO()):
+            yield
+
+def preparse(argv):
+    parser = argparse.ArgumentParser(add_help=False)
+    add_global_arguments(parser)
+    parser.add_argument('subcommand', nargs='?')
+    parser.add_argument('args', nargs=argparse.REMAINDER)
+    try:
+        with silence_stderr():
+            args, _ = parser.parse_known_args(argv)
+    except SystemExit:
+        return None
+    return args
 
-    parser_sync_size = subparsers.add_parser('sync-image')
-    parser_sync_size.add_argument('platform_id')
+def build_parser(subcommand=None):
+    parser = argparse.ArgumentParser()
+    add_global_arguments(parser)
+    if subcommand not in ENDPOINTS and subcommand not in TOOLS:
+        parser.add_argument('subcommand', choices=[*ENDPOINTS, *TOOLS])
+        return parser
+    subparsers = parser.add_subparsers(dest='subcommand', required=True)
+    parser_command = subparsers.add_parser(subcommand)
+    if subcommand in ENDPOINTS:
+        add_endpoint_arguments(parser_command, ENDPOINTS[subcommand])
+    else:
+        TOOLS[subcommand][1](parser_command)
+    return parser
 
-    parser_sync_host = subparsers.add_parser('sync-host')
-    parser_sync_host.add_argument('platform_id')
-    parser_sync_host.add_argument('json_file')
+@lru_cache(maxsize=None)
+def command_parser(subcommand):
+    return build_parser(subcommand)
 
-    parser_sync_machine = subparsers.add_parser('sync-machine')
-    parser_sync_machine.add_argument('platform_id')
-    parser_sync_machine.add_argument('json_file')
-
-    parser_sync_pf_network = subparsers.add_parser('sync-pf-network')
-    parser_sync_pf_network.add_argument('platform_id')
+def parse_argv(argv):
+    options = preparse(argv)
+    return command_parser(options.subcommand if options else None).parse_args(argv)
 
-    parser_sync_network = subparsers.add_parser('sync-network')
-    parser_sync_network.add_argument('platform_id')
-    parser_sync_network.add_argument('json_file')
-
-    parser_sync_volume = subparsers.add_parser('sync-volume')
-    parser_sync_volume.add_argument('platform_id')
-    parser_sync_volume.add_argument('json_file')
-
-    parser_sync_template = subparsers.add_parser('sync-template')
-    parser_sync_template.add_argument('platform_id')
+def run_command(args, method):
+    return method(*[getattr(args, name) for name in ENDPOINTS[args.subcommand].args])
+
+def run_endpoint(api, args):
+    text = run_command(args, getattr(api, command_method(args.subcommand)))
+    if getattr(args, 'wait', False):
+        return wait_after_action(api, args, text)
+
+def read_batch(json_file):
+    stream = sys.stdin if json_file == '-' else open(json_file, 'r')
+    try:
+        for lineno, line in enumerate(stream, 1):
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield lineno, line
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+def batch_args(record):
+    subcommand = record.get('subcommand')
+    if subcommand not in ENDPOINTS:
+        raise ValueError(f'invalid subcommand: {subcommand}')
+    args = record.get('args') or []
+    if isinstance(args, dict):
+        return argparse.Namespace(subcommand=subcommand, **args)
+    try:
+        with silence_stderr():
+            return command_parser(subcommand).parse_args([subcommand] + [str(arg) for arg in args])
+    except SystemExit:
+        raise ValueError(f'invalid arguments for {subcommand}: {args}')
+
+def prepare_batch_record(lineno, line):
+    result = {'line': lineno}
+    try:
+        record = json.loads(line)
+        if 'id' in record:
+            result['id'] = record['id']
+        args = batch_args(record)
+        result['subcommand'] = args.subcommand
+    except Exception as e:
+        result['ok'] = False
+        result['error'] = f'{type(e).__name__}: {e}'
+        return result, None
+    return result, args
+
+def run_batch_record(api, result, args):
+    if args is None:
+        return result
+    try:
+        text = run_command(args, getattr(api, command_method(args.subcommand)))
+    except Exception as e:
+        result['ok'] = False
+        result['error'] = f'{type(e).__name__}: {e}'
+        return result
+    try:
+        result['result'] = json.loads(text)
+    except (TypeError, ValueError):
+        result['result'] = text
+    result['ok'] = True
+    return result
+
+def write_json_line(data):
+    sys.stdout.write(json.dumps(data) + '\n')
+    sys.stdout.flush()
+
+def add_batch_arguments(parser):
+    parser.add_argument('json_file', nargs='?', default='-',
+                        help="JSONL file of {subcommand, args} records(default:stdin)")
+    parser.add_argument('-w', '--workers', type=int, default=8,
+                        help="Number of concurrent calls(default:8)")
+    parser.add_argument('--unordered', action='store_true',
+                        help="Write results as calls complete instead of in input order")
+
+def run_batch(api, args):
+    from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+    api.quiet = True
+    api.start_token_refresher()
+    window = args.workers * 2
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        if args.unordered:
+            pending = set()
+            for lineno, line in read_batch(args.json_file):
+                result, call_args = prepare_batch_record(lineno, line)
+                pending.add(executor.submit(run_batch_record, api, result, call_args))
+                if len(pending) >= window:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        write_json_line(future.result())
+            for future in as_completed(pending):
+                write_json_line(future.result())
+        else:
+            pending = deque()
+            for lineno, line in read_batch(args.json_file):
+                result, call_args = prepare_batch_record(lineno, line)
+                pending.append(executor.submit(run_batch_record, api, result, call_args))
+                while pending and (pending[0].done() or len(pending) >= window):
+                    write_json_line(pending.popleft().result())
+            while pending:
+                write_json_line(pending.popleft().result())
+
+INVENTORY_RESOURCES = {
+    'machines': ('machine', 'do_list_machines'),
+    'volumes': ('volume', 'do_list_volumes'),
+    'networks': ('network', 'do_list_networks'),
+    'security-groups': ('security-group', 'do_list_security_groups'),
+}
+
+def parse_list(text):
+    data = json.loads(text)
+    if not isinstance(data, list):
+        raise ValueError(f'expected a list, got: {text[:200]}')
+    return data
+
+def crawl_inventory(api, platforms, resources, workers=16, per_platform=4):
+    from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+    queues = {platform['id']: deque() for platform in platforms}
+    inflight = dict.fromkeys(queues, 0)
+    pending = {}
+    for platform in platforms:
+        yield {'kind': 'platform', 'platform_id': platform['id'], 'data': platform}
+        queues[platform['id']].append(('cloud', None, api.do_list_clouds, (platform['id'],)))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        def schedule():
+            for platform_id, queue in queues.items():
+                while queue and inflight[platform_id] < per_platform:
+                    kind, cloud_id, method, call_args = queue.popleft()
+                    future = executor.submit(method, *call_args)
+                    pending[future] = (platform_id, cloud_id, kind)
+                    inflight[platform_id] += 1
+
+        schedule()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                platform_id, cloud_id, kind = pending.pop(future)
+                inflight[platform_id] -= 1
+                try:
+                    items = parse_list(future.result())
+                except Exception as e:
+                    yield {'kind': 'error', 'platform_id': platform_id, 'cloud_id': cloud_id,
+                           'resource': kind, 'error': f'{type(e).__name__}: {e}'}
+                    continue
+                for item in items:
+                    record = {'kind': kind, 'platform_id': platform_id}
+                    if cloud_id:
+                        record['cloud_id'] = cloud_id
+                    record['data'] = item
+                    yield record
+                    if kind == 'cloud':
+                        for resource in resources:
+                            resource_kind, method_name = INVENTORY_RESOURCES[resource]
+                            queues[platform_id].append((resource_kind, item['id'],
+                                getattr(api, method_name), (platform_id, item['id'])))
+            schedule()
+
+def add_inventory_arguments(parser):
+    parser.add_argument('platform_ids', nargs='*',
+                        help="Platforms to crawl(default:all)")
+    parser.add_argument('-w', '--workers', type=int, default=16,
+                        help="Number of concurrent calls(default:16)")
+    parser.add_argument('--per-platform', type=int, default=4,
+                        help="Number of concurrent calls per platform(default:4)")
+    parser.add_argument('--resources', default=','.join(INVENTORY_RESOURCES),
+                        help="Comma separated cloud resources to list(default:%(default)s)")
+
+def run_inventory(api, args):
+    api.quiet = True
+    api.start_token_refresher()
+    resources = [resource for resource in args.resources.split(',') if resource]
+    for resource in resources:
+        if resource not in INVENTORY_RESOURCES:
+            raise SystemExit(f'unknown resource: {resource}')
+    platforms = parse_list(api.do_list_platforms())
+    if args.platform_ids:
+        platforms = [platform for platform in platforms if platform['id'] in args.platform_ids]
+    for record in crawl_inventory(api, platforms, resources,
+                                  workers=args.workers, per_platform=args.per_platform):
+        write_json_line(record)
+
+ACTION_STATES = {
+    'start': 'running',
+    'stop': 'stopped',
+    'reboot': 'running',
+    'resume': 'running',
+    'suspend': 'suspended',
+}
+TRANSITIONAL_STATES = ('pending', 'starting', 'stopping', 'rebooting', 'creating',
+                       'deleting', 'migrating', 'resuming', 'suspending', 'unknown', None)
+
+def state_predicate(states, not_states):
+    if states:
+        return lambda state: state in states and state not in not_states
+    if not_states:
+        return lambda state: state not in not_states
+    return lambda state: state not in TRANSITIONAL_STATES
+
+def wait_for_states(targets, reached, timeout=600, interval=1, max_interval=30, workers=8):
+    from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+    start = time.monotonic()
+    deadline = start + timeout
+    heap = [(start, key, interval) for key in targets]
+    heapq.heapify(heap)
+    last_state = {}
+    polls = dict.fromkeys(targets, 0)
+    pending = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while heap or pending:
+            now = time.monotonic()
+            while heap and heap[0][0] <= now:
+                _, key, delay = heapq.heappop(heap)
+                pending[executor.submit(targets[key])] = (key, delay)
+            next_poll = heap[0][0] - now if heap else None
+            if not pending:
+                time.sleep(next_poll)
+                continue
+            done, _ = wait(pending, timeout=next_poll, return_when=FIRST_COMPLETED)
+            for future in done:
+                key, delay = pending.pop(future)
+                polls[key] += 1
+                result = {'id': key}
+                try:
+                    state = future.result().get('state')
+                except Exception as e:
+                    state = last_state.get(key)
+                    result['error'] = f'{type(e).__name__}: {e}'
+                now = time.monotonic()
+                result.update(state=state, elapsed=round(now - start, 3), polls=polls[key])
+                if reached(state) and 'error' not in result:
+                    yield dict(result, ok=True)
+                elif now >= deadline:
+                    yield dict(result, ok=False, error=result.get('error', 'timeout'))
+                else:
+                    if key in last_state and state != last_state[key]:
+                        delay = interval
+                    else:
+                        delay = min(delay * 2, max_interval)
+                    last_state[key] = state
+                    next_poll = now + random.uniform(delay / 2, delay)
+                    heapq.heappush(heap, (min(next_poll, deadline), key, delay))
+
+def add_wait_command_arguments(parser):
+    wait_subparsers = parser.add_subparsers(dest='kind', required=True)
+    parser_wait_machine = wait_subparsers.add_parser('machine')
+    parser_wait_machine.add_argument('platform_id')
+    parser_wait_machine.add_argument('cloud_id')
+    parser_wait_machine.add_argument('machine_ids', nargs='+')
+    add_wait_arguments(parser_wait_machine)
+    parser_wait_template = wait_subparsers.add_parser('template')
+    parser_wait_template.add_argument('platform_id')
+    parser_wait_template.add_argument('template_ids', nargs='+')
+    add_wait_arguments(parser_wait_template)
+
+def run_wait(api, args, ids=None, action=None):
+    states = args.state
+    if not states and not args.not_state and action in ACTION_STATES:
+        states = [ACTION_STATES[action]]
+    reached = state_predicate(states, args.not_state)
+    if args.subcommand == 'template-action' or getattr(args, 'kind', None) == 'template':
+        ids = ids or args.template_ids
+        targets = {id: partial(api.fetch_template, args.platform_id, id) for id in ids}
+    else:
+        ids = ids or args.machine_ids
+        targets = {id: partial(api.fetch_machine, args.platform_id, args.cloud_id, id) for id in ids}
+    failed = 0
+    for result in wait_for_states(targets, reached, timeout=args.timeout,
+                                  interval=args.interval, max_interval=args.max_interval):
+        failed += not result['ok']
+        write_json_line(result)
+    return failed
+
+def created_ids(text):
+    try:
+        data = json.loads(text)
+    except (TypeError, ValueError):
+        return []
+    records = data if isinstance(data, list) else [data]
+    ids = []
+    for record in records:
+        if isinstance(record, dict):
+            id = record.get('id') or record.get('machine_id') or record.get('uuid')
+            if id:
+                ids.append(id)
+    return ids
+
+def wait_after_action(api, args, text):
+    if args.subcommand == 'machine-action':
+        with open(args.json_file, 'r') as ff:
+            action = json.load(ff).get('action')
+        return run_wait(api, args, ids=[args.machine_id], action=action)
+    if args.subcommand == 'template-action':
+        return run_wait(api, args, ids=[args.template_id])
+    ids = created_ids(text)
+    if not ids:
+        print('no machine id found in the response, nothing to wait for', file=sys.stderr)
+        return 1
+    return run_wait(api, args, ids=ids, action='start')
+
+def match_filters(record, filters):
+    for key, pattern in filters:
+        if not fnmatch.fnmatchcase(str(record.get(key)), pattern):
+            return False
+    return True
+
+def select_machine_ids(api, args):
+    ids = list(args.machine_ids)
+    if args.ids_file:
+        stream = sys.stdin if args.ids_file == '-' else open(args.ids_file, 'r')
+        with stream:
+            ids.extend(line.strip() for line in stream if line.strip())
+    if args.filter or not ids:
+        filters = [item.split('=', 1) for item in args.filter]
+        for key_value in filters:
+            if len(key_value) != 2:
+                raise SystemExit(f'invalid filter, expected key=pattern: {key_value[0]}')
+        machines = parse_list(api.do_list_machines(args.platform_id, args.cloud_id))
+        ids.extend(machine['id'] for machine in machines if match_filters(machine, filters))
+    return list(dict.fromkeys(ids))
+
+def summarize_latencies(latencies):
+    return {
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'max': max(latencies) if latencies else None,
+    }
+
+def run_timed(limiter, method, *call_args):
+    limiter.acquire()
+    start = time.monotonic()
+    try:
+        text = method(*call_args)
+    except Exception as e:
+        return {'ok': False, 'latency': round(time.monotonic() - start, 3),
+                'error': f'{type(e).__name__}: {e}'}
+    return {'ok': True, 'latency': round(time.monotonic() - start, 3), 'response': text}
+
+def add_bulk_machine_action_arguments(parser):
+    parser.add_argument('platform_id')
+    parser.add_argument('cloud_id')
+    parser.add_argument('json_file')
+    parser.add_argument('machine_ids', nargs='*')
+    parser.add_argument('--ids-file',
+                        help="File with one machine id per line, '-' for stdin")
+    parser.add_argument('--filter', action='append', default=[],
+                        help="Select machines from list-machines by key=pattern, may be repeated")
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help="Number of concurrent actions(default:16)")
+    parser.add_argument('--rate', type=float, default=0,
+                        help="Max actions started per second(default:unlimited)")
+    add_wait_arguments(parser, flag=True)
+
+def run_bulk_machine_action(api, args):
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    api.quiet = True
+    api.start_token_refresher()
+    with open(args.json_file, 'r') as ff:
+        action = json.load(ff).get('action')
+    machine_ids = select_machine_ids(api, args)
+    limiter = RateLimiter(args.rate)
+    results = {}
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = {executor.submit(run_timed, limiter, api.do_machine_action, args.platform_id,
+                                   args.cloud_id, machine_id, args.json_file): machine_id
+                   for machine_id in machine_ids}
+        for future in as_completed(futures):
+            result = future.result()
+            result.pop('response', None)
+            results[futures[future]] = dict(id=futures[future], **result)
+    elapsed = time.monotonic() - start
+    succeeded = [id for id, result in results.items() if result['ok']]
+    if args.wait and succeeded:
+        states = args.state or ([ACTION_STATES[action]] if action in ACTION_STATES else [])
+        targets = {id: partial(api.fetch_machine, args.platform_id, args.cloud_id, id)
+                   for id in succeeded}
+        for state in wait_for_states(targets, state_predicate(states, args.not_state),
+                                     timeout=args.timeout, interval=args.interval,
+                                     max_interval=args.max_interval, workers=args.concurrency):
+            results[state['id']].update(state=state['state'], wait_elapsed=state['elapsed'])
+            if not state['ok']:
+                results[state['id']].update(ok=False, error=state['error'])
+        elapsed = time.monotonic() - start
+    latencies = [result['latency'] for result in results.values()]
+    failed = sum(not result['ok'] for result in results.values())
+    summary = {
+        'action': action,
+        'total': len(results),
+        'succeeded': len(results) - failed,
+        'failed': failed,
+        'elapsed': round(elapsed, 3),
+        'latency': summarize_latencies(latencies),
+        'results': [results[id] for id in machine_ids],
+    }
+    print(json.dumps(summary, indent=2))
+    return failed
+
+def print_table(headers, rows):
+    rows = [['' if value is None else str(value) for value in row] for row in rows]
+    widths = [max([len(header)] + [len(row[i]) for row in rows]) for i, header in enumerate(headers)]
+    print('  '.join(header.ljust(width) for header, width in zip(headers, widths)).rstrip())
+    for row in rows:
+        print('  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip())
+
+def add_create_machines_from_template_arguments(parser):
+    parser.add_argument('platform_id')
+    parser.add_argument('cloud_id')
+    parser.add_argument('json_file')
+    parser.add_argument('-n', '--count', type=int, required=True,
+                        help="Number of machines to create")
+    parser.add_argument('--name-pattern', default='{name}-{index:03d}',
+                        help="Name of each replica, formatted with name and index(default:%(default)s)")
+    parser.add_argument('--name-key', default='name',
+                        help="Body field that holds the machine name(default:name)")
+    parser.add_argument('--start-index', type=int, default=1,
+                        help="Index of the first replica(default:1)")
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help="Number of concurrent creations(default:8)")
+    parser.add_argument('--rate', type=float, default=0,
+                        help="Max creations started per second(default:unlimited)")
+    parser.add_argument('--json', action='store_true',
+                        help="Print the results as JSON instead of a table")
+    add_wait_arguments(parser, flag=True)
+
+def run_create_machines_from_template(api, args):
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    api.quiet = True
+    api.start_token_refresher()
+    with open(args.json_file, 'r') as ff:
+        body = json.load(ff)
+    base_name = body.get(args.name_key, 'vm')
+    replicas = {}
+    for index in range(args.start_index, args.start_index + args.count):
+        name = args.name_pattern.format(name=base_name, index=index)
+        replicas[name] = dict(body, **{args.name_key: name})
+    limiter = RateLimiter(args.rate)
+    results = {}
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = {executor.submit(run_timed, limiter, partial(api.do_create_machine_from_template,
+                                   payload=payload), args.platform_id, args.cloud_id): name
+                   for name, payload in replicas.items()}
+        for future in as_completed(futures):
+            name = futures[future]
+            result = future.result()
+            ids = created_ids(result.pop('response', None))
+            results[name] = dict(name=name, id=ids[0] if ids else None, **result)
+    created = {result['id']: name for name, result in results.items() if result['ok'] and result['id']}
+    if args.wait and created:
+        states = args.state or ([] if args.not_state else ['running'])
+        targets = {id: partial(api.fetch_machine, args.platform_id, args.cloud_id, id) for id in created}
+        for state in wait_for_states(targets, state_predicate(states, args.not_state),
+                                     timeout=args.timeout, interval=args.interval,
+                                     max_interval=args.max_interval, workers=args.concurrency):
+            result = results[created[state['id']]]
+            result.update(state=state['state'], wait_elapsed=state['elapsed'])
+            if not state['ok']:
+                result.update(ok=False, error=state['error'])
+    rows = [results[name] for name in replicas]
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        print_table(['NAME', 'ID', 'OK', 'CREATE(s)', 'STATE', 'READY(s)', 'ERROR'],
+                    [[row['name'], row['id'], row['ok'], row['latency'], row.get('state'),
+                      row.get('wait_elapsed'), row.get('error')] for row in rows])
+    return sum(not row['ok'] for row in rows)
+
+def record_digest(record, ignore=()):
+    if ignore:
+        record = {key: value for key, value in record.items() if key not in ignore}
+    return hashlib.blake2b(json.dumps(record, sort_keys=True).encode(), digest_size=8).digest()
+
+def diff_index(index, records, ignore=()):
+    current = {}
+    for record in records:
+        id = record.get('id')
+        digest = record_digest(record, ignore)
+        current[id] = digest
+        if id not in index:
+            yield 'added', id, record
+        elif index[id] != digest:
+            yield 'changed', id, record
+    for id in index.keys() - current.keys():
+        yield 'removed', id, None
+    index.clear()
+    index.update(current)
+
+def add_watch_arguments(parser):
+    parser.add_argument('platform_id')
+    parser.add_argument('cloud_id')
+    parser.add_argument('--resources', default='machines,volumes',
+                        help="Comma separated cloud resources to watch(default:%(default)s)")
+    parser.add_argument('--interval', type=float, default=30,
+                        help="Seconds between listings(default:30)")
+    parser.add_argument('--ignore', action='append', default=[],
+                        help="Record field to ignore when detecting changes, may be repeated")
+    parser.add_argument('--skip-initial', action='store_true',
+                        help="Do not emit 'added' events for the first listing")
+    parser.add_argument('--count', type=int, default=0,
+                        help="Stop after this many listings(default:run forever)")
+
+def run_watch(api, args):
+    api.quiet = True
+    api.refresh_cache = True
+    api.start_token_refresher()
+    resources = [resource for resource in args.resources.split(',') if resource]
+    for resource in resources:
+        if resource not in INVENTORY_RESOURCES:
+            raise SystemExit(f'unknown resource: {resource}')
+    indexes = {resource: {} for resource in resources}
+    iteration = 0
+    try:
+        while True:
+            started = time.monotonic()
+            for resource in resources:
+                kind, method_name = INVENTORY_RESOURCES[resource]
+                try:
+                    records = parse_list(getattr(api, method_name)(args.platform_id, args.cloud_id))
+                except Exception as e:
+                    write_json_line({'event': 'error', 'kind': kind, 'error': f'{type(e).__name__}: {e}'})
+                    continue
+                for event, id, record in diff_index(indexes[resource], records, args.ignore):
+                    if iteration == 0 and args.skip_initial:
+                        continue
+                    line = {'event': event, 'kind': kind, 'id': id, 'time': time.time()}
+                    if record is not None:
+                        line['data'] = record
+                    write_json_line(line)
+            iteration += 1
+            if args.count and iteration >= args.count:
+                return
+            time.sleep(max(0, args.interval - (time.monotonic() - started)))
+    except KeyboardInterrupt:
+        return
+
+BENCH_OPS = {
+    'list-platforms': ('do_list_platforms', ()),
+    'list-clouds': ('do_list_clouds', ('platform_id',)),
+    'list-images': ('do_list_images', ('platform_id',)),
+    'list-sizes': ('do_list_sizes', ('platform_id',)),
+    'list-templates': ('do_list_templates', ('platform_id',)),
+    'list-machines': ('do_list_machines', ('platform_id', 'cloud_id')),
+    'list-volumes': ('do_list_volumes', ('platform_id', 'cloud_id')),
+    'get-machine': ('do_get_machine', ('platform_id', 'cloud_id', 'machine_id')),
+    'sync-cloud': ('do_sync_cloud', ('platform_id',)),
+    'sync-cluster': ('do_sync_cluster', ('platform_id',)),
+    'sync-image': ('do_sync_image', ('platform_id',)),
+    'sync-template': ('do_sync_template', ('platform_id',)),
+    'sync-volume-type': ('do_sync_volume_type', ('platform_id',)),
+}
+
+def parse_mix(mix):
+    ops = {}
+    for item in mix.split(','):
+        op, _, weight = item.partition('=')
+        if op not in BENCH_OPS:
+            raise SystemExit(f'unknown bench endpoint: {op}')
+        ops[op] = float(weight or 1)
+    return ops
+
+def bench_targets(api, limit=100):
+    targets = []
+    for platform in parse_list(api.do_list_platforms()):
+        for cloud in parse_list(api.do_list_clouds(platform['id'])):
+            machines = parse_list(api.do_list_machines(platform['id'], cloud['id']))
+            for machine in machines[:limit]:
+                targets.append({'platform_id': platform['id'], 'cloud_id': cloud['id'],
+                                'machine_id': machine['id']})
+            if len(targets) >= limit:
+                return targets
+    return targets
+
+def add_bench_arguments(parser):
+    parser.add_argument('--mix', default='list-platforms=1,list-machines=3,get-machine=6',
+                        help="Weighted endpoints to replay, from %s(default:%%(default)s)"
+                             % ','.join(BENCH_OPS))
+    parser.add_argument('-d', '--duration', type=float, default=30,
+                        help="Seconds to run(default:30)")
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help="Number of concurrent clients(default:8)")
+    parser.add_argument('--rate', type=float, default=0,
+                        help="Target requests per second(default:as fast as possible)")
+    parser.add_argument('--json', action='store_true',
+                        help="Print the report as JSON")
+    parser.add_argument('--stub', action='store_true',
+                        help="Run against an in-process stub server instead of --server")
+    parser.add_argument('--stub-latency', type=float, default=0,
+                        help="Latency injected by the stub server in ms(default:0)")
+    parser.add_argument('--stub-machines', type=int, default=100,
+                        help="Machines per cloud served by the stub server(default:100)")
+    parser.add_argument('--stub-record-size', type=int, default=0,
+                        help="Extra bytes of padding per stub record(default:0)")
+
+def run_bench(api, args):
+    from concurrent.futures import ThreadPoolExecutor
+    api.quiet = True
+    api.cache = None
+    api.start_token_refresher()
+    ops = parse_mix(args.mix)
+    targets = bench_targets(api)
+    if not targets:
+        raise SystemExit('no machines found to benchmark against')
+    api.timings = RequestTimings()
+    limiter = RateLimiter(args.rate)
+    names, weights = list(ops), list(ops.values())
+    deadline = time.monotonic() + args.duration
+
+    def client():
+        rng = random.Random()
+        while True:
+            limiter.acquire()
+            if time.monotonic() >= deadline:
+                return
+            method_name, arg_names = BENCH_OPS[rng.choices(names, weights)[0]]
+            target = rng.choice(targets)
+            try:
+                getattr(api, method_name)(*[target[name] for name in arg_names])
+            except Exception:
+                pass
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for future in [executor.submit(client) for _ in range(args.concurrency)]:
+            future.result()
+    elapsed = time.monotonic() - start
+    endpoints = api.timings.summary()
+    latencies = [value for stats in api.timings.endpoints.values() for value in stats['total']]
+    requests_count = sum(row['count'] for row in endpoints)
+    errors = sum(row['errors'] for row in endpoints)
+    report = {
+        'duration': round(elapsed, 3),
+        'concurrency': args.concurrency,
+        'requests': requests_count,
+        'throughput': round(requests_count / elapsed, 1),
+        'error_rate': round(errors / requests_count, 4) if requests_count else 0,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'endpoints': endpoints,
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"requests: {report['requests']} in {report['duration']}s "
+              f"({report['throughput']} req/s, concurrency {args.concurrency})")
+        print(f"errors: {errors} ({report['error_rate'] * 100:.2f}%)")
+        print(f"latency: p50 {report['p50'] * 1000:.1f}ms  p95 {report['p95'] * 1000:.1f}ms  "
+              f"p99 {report['p99'] * 1000:.1f}ms")
+        api.timings.print_summary(file=sys.stdout)
+    api.timings = None
+
+class ThreadLocalStream():
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def target(self):
+        target = getattr(self.local, 'target', None)
+        return self.stream if target is None else target
+
+    def write(self, text):
+        return self.target().write(text)
+
+    def flush(self):
+        return self.target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.target(), name)
+
+    @contextmanager
+    def redirect(self, target):
+        previous = getattr(self.local, 'target', None)
+        self.local.target = target
+        try:
+            yield target
+        finally:
+            self.local.target = previous
+
+class DaemonStream(io.TextIOBase):
+    def __init__(self, file, name, lock):
+        self.file = file
+        self.name = name
+        self.lock = lock
+        self.buffer = []
+
+    def write(self, text):
+        self.buffer.append(text)
+        return len(text)
+
+    def flush(self):
+        if self.buffer:
+            text = ''.join(self.buffer)
+            self.buffer.clear()
+            self.send({self.name: text})
+
+    def send(self, frame):
+        with self.lock:
+            self.file.write(json.dumps(frame).encode() + b'\n')
+
+DAEMON_FILE_ARGUMENTS = ('json_file', 'ids_file', 'timings_export')
+
+def daemon_socket():
+    return os.getenv('RUN_SOCKET') or os.path.join('data', 'run.sock')
+
+def warm_unsupported(api, args):
+    if args.subcommand in ('serve', 'shell'):
+        return args.subcommand
+    if args.record or args.replay:
+        return '--record/--replay'
+    if (args.server or 'localhost') != api.server:
+        return '--server'
+    if getattr(args, 'stub', False):
+        return 'bench --stub'
+    if any(getattr(args, name, None) == '-' for name in DAEMON_FILE_ARGUMENTS):
+        return 'reading stdin'
+    return None
+
+def command_api(api, args):
+    client = api.clone()
+    client.cached = args.cached
+    client.verbose = args.verbose
+    client.ndjson = args.ndjson
+    client.refresh_cache = api.refresh_cache or args.refresh
+    if args.no_cache:
+        client.cache = None
+    if args.timings or args.timings_export:
+        client.timings = RequestTimings()
+    return client
+
+def run_args(api, args):
+    run = TOOLS[args.subcommand][0] if args.subcommand in TOOLS else run_endpoint
+    try:
+        return run(api, args) or 0
+    finally:
+        if api.timings:
+            if args.timings:
+                api.timings.print_summary()
+            if args.timings_export:
+                api.timings.export(args.timings_export, args.timings_format)
+
+def exit_status(e):
+    if isinstance(e.code, str):
+        print(e.code, file=sys.stderr)
+        return 1
+    return e.code or 0
+
+def run_daemon_request(api, line):
+    try:
+        request = json.loads(line)
+        args = parse_argv(request['argv'])
+        unsupported = warm_unsupported(api, args)
+        if unsupported:
+            return {'fallback': unsupported}
+        for name in DAEMON_FILE_ARGUMENTS:
+            if getattr(args, name, None):
+                setattr(args, name, os.path.join(request['cwd'], getattr(args, name)))
+        client = command_api(api, args)
+        client.cached = client.cached or request.get('cached', False)
+        client.verbose = client.verbose or request.get('verbose', False)
+        return {'status': 1 if run_args(client, args) else 0}
+    except SystemExit as e:
+        return {'status': exit_status(e)}
+    except Exception:
+        import traceback
+        traceback.print_exc()
+        return {'status': 1}
+
+def connect_daemon(path):
+    if not os.path.exists(path):
+        return None
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
 
-    parser_poll_image = subparsers.add_parser('poll-image')
-    parser_poll_image.add_argument('platform_id')
-    parser_poll_image.add_argument('json_file')
+def forward_to_daemon(path, argv):
+    sock = connect_daemon(path)
+    if sock is None:
+        return None
+    request = {'argv': argv, 'cwd': os.getcwd(),
+               'cached': env_enabled('CACHED'), 'verbose': env_enabled('VERBOSE')}
+    with sock, sock.makefile('rwb') as stream:
+        stream.write(json.dumps(request).encode() + b'\n')
+        stream.flush()
+        for line in stream:
+            frame = json.loads(line)
+            if 'stdout' in frame:
+                sys.stdout.write(frame['stdout'])
+                sys.stdout.flush()
+            elif 'stderr' in frame:
+                sys.stderr.write(frame['stderr'])
+                sys.stderr.flush()
+            elif 'fallback' in frame:
+                return None
+            else:
+                return frame['status']
+    print(f'daemon on {path} closed the connection', file=sys.stderr)
+    return 1
+
+def add_serve_arguments(parser):
+    parser.add_argument('--socket', default=daemon_socket(),
+                        help="Unix socket to listen on(default:%(default)s)")
+
+def stop_serving(signum, frame):
+    raise KeyboardInterrupt
+
+def run_serve(api, args):
+    import signal
+    import socketserver
+    sock = connect_daemon(args.socket)
+    if sock is not None:
+        sock.close()
+        raise SystemExit(f'a daemon is already listening on {args.socket}')
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+    os.makedirs(os.path.dirname(args.socket) or '.', exist_ok=True)
+    api.get_session()
+    api.start_token_refresher()
+    sys.stdout = ThreadLocalStream(sys.stdout)
+    sys.stderr = ThreadLocalStream(sys.stderr)
+
+    class DaemonHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            lock = threading.Lock()
+            stdout = DaemonStream(self.wfile, 'stdout', lock)
+            stderr = DaemonStream(self.wfile, 'stderr', lock)
+            try:
+                for line in self.rfile:
+                    with sys.stdout.redirect(stdout), sys.stderr.redirect(stderr):
+                        reply = run_daemon_request(api, line)
+                    stdout.flush()
+                    stderr.flush()
+                    stdout.send(reply)
+            except OSError:
+                pass
+
+    umask = os.umask(0o177)
+    try:
+        server = socketserver.ThreadingUnixStreamServer(args.socket, DaemonHandler)
+    finally:
+        os.umask(umask)
+    server.daemon_threads = True
+    signal.signal(signal.SIGTERM, stop_serving)
+    print(f'serving {api.server} on {args.socket}', file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+
+def add_shell_arguments(parser):
+    pass
+
+def run_shell_line(api, line):
+    import shlex
+    try:
+        args = parse_argv(shlex.split(line))
+        unsupported = warm_unsupported(api, args)
+        if unsupported:
+            print(f'{unsupported} is not available in the shell', file=sys.stderr)
+            return
+        run_args(command_api(api, args), args)
+    except SystemExit as e:
+        exit_status(e)
+    except KeyboardInterrupt:
+        print(file=sys.stderr)
+    except Exception as e:
+        print(f'{type(e).__name__}: {e}', file=sys.stderr)
+
+def run_shell(api, args):
+    import cmd
+    api.get_session()
+    api.start_token_refresher()
+    names = [*ENDPOINTS, *TOOLS]
+
+    class Shell(cmd.Cmd):
+        prompt = 'mist> '
+        intro = f'connected to {api.server}, type help for commands, exit or Ctrl-D to quit'
+
+        def preloop(self):
+            try:
+                import readline
+                readline.set_completer_delims(' \t\n')
+            except ImportError:
+                pass
 
-    parser_poll_template = subparsers.add_parser('poll-template')
-    parser_poll_template.add_argument('platform_id')
-    parser_poll_template.add_argument('json_file')
+        def emptyline(self):
+            pass
 
-    parser_poll_host = subparsers.add_parser('poll-host')
-    parser_poll_host.add_argument('platform_id')
-    parser_poll_host.add_argument('cluster_id')
-    parser_poll_host.add_argument('json_file')
+        def default(self, line):
+            run_shell_line(api, line)
 
-    parser_poll_machine = subparsers.add_parser('poll-machine')
-    parser_poll_machine.add_argument('platform_id')
-    parser_poll_machine.add_argument('cloud_id')
-    parser_poll_machine.add_argument('json_file')
+        def completenames(self, text, *ignored):
+            return [name for name in names + ['help', 'exit'] if name.startswith(text)]
 
-    parser_poll_volume = subparsers.add_parser('poll-volume')
-    parser_poll_volume.add_argument('platform_id')
-    parser_poll_volume.add_argument('cloud_id')
-    parser_poll_volume.add_argument('json_file')
+        def do_help(self, arg):
+            if arg:
+                run_shell_line(api, f'{arg} --help')
+            else:
+                self.columnize(names)
 
-    parser_template_action = subparsers.add_parser('template-action')
-    parser_template_action.add_argument('platform_id') 
-    parser_template_action.add_argument('template_id') 
-    parser_template_action.add_argument('json_file') 
+        def do_exit(self, arg):
+            return True
 
-    args = parser.parse_args()
-    return args
+        def do_EOF(self, arg):
+            print()
+            return True
 
-def run_command(args, method):
-    if args.subcommand in ('list-platforms','list-tokens'):
-        return method()
-    elif args.subcommand in ('add-platform','update-platform'):
-        return method(args.json_file)
-    else:
-        if args.subcommand in ('list-clouds','list-images','list-sizes','list-templates',
-            'list-volume-types','list-pf-networks','ping-platform','delete-platform',
-            'list-clusters','sync-volume-type','sync-cloud','sync-cluster',
-            'sync-pf-network','sync-image','sync-template'):
-            return method(args.platform_id)
-        elif args.subcommand in ('list-machines','list-volumes','list-networks',
-            'list-security-groups'):
-            return method(args.platform_id, args.cloud_id)
-        elif args.subcommand in ('get-size'):
-            return method(args.platform_id, args.size_id)
-        elif args.subcommand in ('get-image'):
-            return method(args.platform_id, args.image_id)
-        elif args.subcommand in ('get-template', 'delete-template'):
-            return method(args.platform_id, args.template_id)
-        elif args.subcommand in ('list-hosts'):
-            return method(args.platform_id, args.cluster_id)
-        elif args.subcommand in ('sync-host','sync-machine','sync-network','sync-volume',
-            'poll-image','poll-template'):
-            return method(args.platform_id, args.json_file)
-        elif args.subcommand in ('poll-host'):
-            return method(args.platform_id, args.cluster_id, args.json_file)
-        elif args.subcommand in ('create-machine','create-machine-from-template',
-            'poll-machine','poll-volume'):
-            return method(args.platform_id, args.cloud_id, args.json_file)
-        elif args.subcommand in ('get-machine', 'delete-machine', 'get-machine-console'):
-            return method(args.platform_id, args.cloud_id, args.machine_id)
-        elif args.subcommand == 'get-volume':
-            return method(args.platform_id, args.cloud_id, args.volume_id)
-        elif args.subcommand == 'get-network':
-            return method(args.platform_id, args.cloud_id, args.network_id)
-        elif args.subcommand == 'machine-action':
-            return method(args.platform_id, args.cloud_id, args.machine_id, args.json_file)
-        elif args.subcommand == 'template-action':
-            return method(args.platform_id, args.template_id, args.json_file)
-    return
+    shell = Shell()
+    while True:
+        try:
+            shell.cmdloop()
+            return
+        except KeyboardInterrupt:
+            print()
+            shell.intro = ''
+
+TOOLS = {
+    'bulk-machine-action': (run_bulk_machine_action, add_bulk_machine_action_arguments),
+    'create-machines-from-template': (run_create_machines_from_template,
+                                      add_create_machines_from_template_arguments),
+    'watch': (run_watch, add_watch_arguments),
+    'bench': (run_bench, add_bench_arguments),
+    'wait': (run_wait, add_wait_command_arguments),
+    'batch': (run_batch, add_batch_arguments),
+    'inventory': (run_inventory, add_inventory_arguments),
+    'serve': (run_serve, add_serve_arguments),
+    'shell': (run_shell, add_shell_arguments),
+}
 
 def main():
-    args = parse_argument()
+    argv = sys.argv[1:]
+    options = preparse(argv)
+    if options and options.subcommand not in (None, 'serve', 'shell') and not options.no_daemon:
+        status = forward_to_daemon(daemon_socket(), argv)
+        if status is not None:
+            sys.exit(status)
+    args = parse_argv(argv)
     server = args.server or 'localhost'
-    if args.cached:
-        os.environ['CACHED'] = 'TRUE'
-    if args.verbose:
-        os.environ['VERBOSE'] = 'TRUE'
-    api = API(server=server)
-    method_name = f"do_{args.subcommand.replace('-', '_')}"
-    if hasattr(api, method_name):
-        method = getattr(api, method_name)
-        run_command(args, method)
-    else:
-        print(f'unknown command: {args.subcommand}')
+    if args.subcommand == 'bench' and args.stub:
+        import stub_server
+        stub = stub_server.start_server(latency=args.stub_latency, machines=args.stub_machines,
+                                        record_size=args.stub_record_size)
+        server = '%s:%s' % stub.server_address
+        args.no_cache = True
+    cassette = None
+    if args.record or args.replay:
+        cassette = Cassette(args.record or args.replay, replay=bool(args.replay))
+        args.no_cache = True
+    pool_size = max(args.pool_size, getattr(args, 'workers', 0), getattr(args, 'concurrency', 0))
+    api = API(server=server, pool_size=pool_size,
+              connect_timeout=args.connect_timeout, read_timeout=args.read_timeout,
+              use_cache=not args.no_cache, refresh_cache=args.refresh,
+              cache_size=args.cache_size,
+              timings=RequestTimings() if args.timings or args.timings_export else None,
+              cassette=cassette)
+    api.cached = args.cached
+    api.verbose = args.verbose
+    api.ndjson = args.ndjson
+    try:
+        failed = run_args(api, args)
+    finally:
+        api.close()
+    if failed:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+import argparse
+import datetime
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+def make_id(*parts):
+    return hashlib.md5('/'.join(str(part) for part in parts).encode()).hexdigest()
+
+class Inventory():
+    def __init__(self, platforms=2, clouds=2, clusters=2, hosts=8, machines=100, volumes=50,
+                 networks=4, images=20, sizes=10, templates=10, record_size=0, action_delay=2):
+        self.lock = threading.Lock()
+        self.record_size = record_size
+        self.action_delay = action_delay
+        self.counts = {
+            'clouds': clouds, 'clusters': clusters, 'hosts': hosts, 'machines': machines,
+            'volumes': volumes, 'networks': networks, 'security-groups': networks,
+            'images': images, 'sizes': sizes, 'templates': templates, 'volume_types': 3,
+        }
+        self.platforms = [self.record('platform', make_id('platform', index),
+                                      title=f'platform{index}', provider='zstack', enabled=True,
+                                      state='online', polling_interval=1800)
+                          for index in range(platforms)]
+        self.collections = {}
+        self.states = {}
+
+    def record(self, kind, id, **fields):
+        record = dict(id=id, name=f'{kind}-{id[:8]}', **fields)
+        if self.record_size:
+            record['description'] = 'x' * self.record_size
+        return record
+
+    def collection(self, kind, *scope):
+        key = (kind,) + scope
+        with self.lock:
+            records = self.collections.get(key)
+            if records is None:
+                records = [self.make_record(kind, scope, index) for index in range(self.counts[kind])]
+                self.collections[key] = records
+            return records
+
+    def make_record(self, kind, scope, index):
+        id = make_id(kind, *scope, index)
+        singular = kind.rstrip('s')
+        if kind == 'machines':
+            return self.record(singular, id, state='running', cpu=4, memory=8192,
+                               image_id=make_id('images', scope[0], index % self.counts['images']),
+                               size_id=make_id('sizes', scope[0], index % self.counts['sizes']))
+        if kind == 'hosts':
+            return self.record(singular, id, state='connected', cpu_total=64, cpu_used=index % 64,
+                               memory_total=524288, memory_used=(index * 16384) % 524288,
+                               storage_total=8 * 1024 ** 4, storage_used=(index * 1024 ** 4) % (8 * 1024 ** 4))
+        if kind == 'volumes':
+            return self.record(singular, id, state='available', size=100)
+        return self.record(singular, id, state='ready')
+
+    def find(self, kind, scope, id):
+        for record in self.collection(kind, *scope):
+            if record['id'] == id:
+                return self.current(record)
+        return None
+
+    def current(self, record):
+        with self.lock:
+            transition = self.states.get(record['id'])
+            if transition:
+                state, ready_at = transition
+                if time.time() >= ready_at:
+                    record['state'] = state
+                    del self.states[record['id']]
+                else:
+                    return dict(record, state='pending')
+            return record
+
+    def transition(self, record, state):
+        with self.lock:
+            self.states[record['id']] = (state, time.time() + self.action_delay)
+
+    def create(self, kind, scope, body):
+        with self.lock:
+            records = self.collections.get((kind,) + scope)
+        if records is None:
+            records = self.collection(kind, *scope)
+        record = self.record(kind.rstrip('s'), make_id(kind, *scope, time.time(), random.random()),
+                             state='pending')
+        record.update(body)
+        with self.lock:
+            records.append(record)
+        self.transition(record, 'running')
+        return record
+
+ACTION_STATES = {'start': 'running', 'stop': 'stopped', 'reboot': 'running',
+                 'suspend': 'suspended', 'resume': 'running'}
+
+ROUTES = []
+
+def route(method, pattern):
+    def decorator(function):
+        ROUTES.append((method, re.compile(f'^/api/v1{pattern}$'), function))
+        return function
+    return decorator
+
+@route('POST', '/tokens')
+def create_token(inventory, body):
+    created_at = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S.%f')
+    return 200, {'token': make_id('token', time.time()), 'created_at': created_at, 'ttl': 3600}
+
+@route('GET', '/tokens')
+def list_tokens(inventory, body):
+    return 200, []
+
+@route('GET', '/platforms')
+def list_platforms(inventory, body):
+    return 200, inventory.platforms
+
+@route('POST', '/platforms')
+@route('PATCH', '/platforms')
+def save_platform(inventory, body):
+    return 200, dict(body, id=make_id('platform', body.get('title')))
+
+@route('DELETE', '/platforms/(?P<platform_id>[^/]+)')
+@route('DELETE', '/platforms/(?P<platform_id>[^/]+)/templates/(?P<template_id>[^/]+)')
+@route('DELETE', '/platforms/(?P<platform_id>[^/]+)/clouds/(?P<cloud_id>[^/]+)/machines/(?P<machine_id>[^/]+)')
+def delete(inventory, body, **ids):
+    return 200, {'deleted': ids}
+
+@route('POST', '/platform/ping')
+def ping_platform(inventory, body):
+    return 200, {'state': 'online'}
+
+@route('GET', '/platforms/(?P<platform_id>[^/]+)/(?P<kind>clouds|clusters|images|sizes|templates|networks|volume_types)')
+def list_platform_resources(inventory, body, platform_id, kind):
+    return 200, inventory.collection(kind, platform_id)
+
+@route('GET', '/platforms/(?P<platform_id>[^/]+)/(?P<kind>images|sizes|templates)/(?P<id>[^/]+)')
+def get_platform_resource(inventory, body, platform_id, kind, id):
+    record = inventory.find(kind, (platform_id,), id)
+    return (200, record) if record else (404, {'error': f'{kind} {id} not found'})
+
+@route('GET', '/platforms/(?P<platform_id>[^/]+)/clusters/(?P<cluster_id>[^/]+)/hosts')
+def list_hosts(inventory, body, platform_id, cluster_id):
+    return 200, inventory.collection('hosts', platform_id, cluster_id)
+
+@route('GET', '/platforms/(?P<platform_id>[^/]+)/clouds/(?P<cloud_id>[^/]+)/(?P<kind>machines|volumes|networks|security-groups)')
+def list_cloud_resources(inventory, body, platform_id, cloud_id, kind):
+    return 200, inventory.collection(kind, platform_id, cloud_id)
+
+@route('GET', '/platforms/(?P<platform_id>[^/]+)/clouds/(?P<cloud_id>[^/]+)/(?P<kind>machines|volumes|networks)/(?P<id>[^/]+)')
+def get_cloud_resource(inventory, body, platform_id, cloud_id, kind, id):
+    record = inventory.find(kind, (platform_id, cloud_id), id)
+    return (200, record) if record else (404, {'error': f'{kind} {id} not found'})
+
+@route('GET', '/platforms/(?P<platform_id>[^/]+)/clouds/(?P<cloud_id>[^/]+)/machines/(?P<id>[^/]+)/console')
+def get_machine_console(inventory, body, platform_id, cloud_id, id):
+    return 200, {'url': f'vnc://console/{id}'}
+
+@route('POST', '/platforms/(?P<platform_id>[^/]+)/clouds/(?P<cloud_id>[^/]+)/(?:machines|machines_from_template)')
+def create_machine(inventory, body, platform_id, cloud_id):
+    return 200, inventory.create('machines', (platform_id, cloud_id), body)
+
+@route('POST', '/platforms/(?P<platform_id>[^/]+)/clouds/(?P<cloud_id>[^/]+)/machines/(?P<id>[^/]+)')
+def machine_action(inventory, body, platform_id, cloud_id, id):
+    record = inventory.find('machines', (platform_id, cloud_id), id)
+    if not record:
+        return 404, {'error': f'machine {id} not found'}
+    inventory.transition(record, ACTION_STATES.get(body.get('action'), record['state']))
+    return 200, {'id': id, 'action': body.get('action')}
+
+@route('POST', '/platforms/(?P<platform_id>[^/]+)/templates/(?P<id>[^/]+)/action')
+def template_action(inventory, body, platform_id, id):
+    record = inventory.find('templates', (platform_id,), id)
+    if not record:
+        return 404, {'error': f'template {id} not found'}
+    inventory.transition(record, 'ready')
+    return 200, {'id': id, 'action': body.get('action')}
+
+@route('POST', '/platforms/(?P<platform_id>[^/]+)/(?P<kind>[a-z_]+)/sync')
+def sync(inventory, body, platform_id, kind):
+    return 200, {'platform_id': platform_id, 'sync': kind, 'body': body}
+
+@route('POST', '/platforms/(?P<platform_id>[^/]+)/(?:(?:image|template)/update_poller'
+               '|clusters/[^/]+/update_poller|clouds/[^/]+/update(?:_volume)?_poller)')
+def update_poller(inventory, body, platform_id):
+    return 200, dict(body, platform_id=platform_id)
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def handle_request(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        server = self.server
+        if server.latency or server.jitter:
+            time.sleep(max(0, server.latency + random.uniform(-server.jitter, server.jitter)) / 1000)
+        if server.error_rate and random.random() < server.error_rate:
+            return self.send_json(503, {'error': 'injected failure'})
+        try:
+            body = json.loads(raw) if raw else {}
+        except ValueError:
+            body = {}
+        if not isinstance(body, dict):
+            body = {}
+        path = urlparse(self.path).path
+        for method, pattern, function in ROUTES:
+            if method != self.command:
+                continue
+            match = pattern.match(path)
+            if match:
+                status, data = function(server.inventory, body, **match.groupdict())
+                return self.send_json(status, data)
+        return self.send_json(404, {'error': f'no route for {self.command} {path}'})
+
+    do_GET = do_POST = do_PATCH = do_DELETE = handle_request
+
+    def send_json(self, status, data):
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+def make_server(host='127.0.0.1', port=0, latency=0, jitter=0, error_rate=0, verbose=False, **counts):
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.inventory = Inventory(**counts)
+    server.latency = latency
+    server.jitter = jitter
+    server.error_rate = error_rate
+    server.verbose = verbose
+    return server
+
+def start_server(**options):
+    server = make_server(**options)
+    thread = threading.Thread(target=server.serve_forever, name='stub-server', daemon=True)
+    thread.start()
+    return server
+
+def parse_argument():
+    parser = argparse.ArgumentParser(description="Local stub of the mist /api/v1 routes used by run.py")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0, help="Injected latency in ms(default:0)")
+    parser.add_argument('--jitter', type=float, default=0, help="Random +/- latency in ms(default:0)")
+    parser.add_argument('--error-rate', type=float, default=0, help="Fraction of requests answered with 503(default:0)")
+    parser.add_argument('--platforms', type=int, default=2)
+    parser.add_argument('--clouds', type=int, default=2, help="Clouds per platform(default:2)")
+    parser.add_argument('--clusters', type=int, default=2, help="Clusters per platform(default:2)")
+    parser.add_argument('--hosts', type=int, default=8, help="Hosts per cluster(default:8)")
+    parser.add_argument('--machines', type=int, default=100, help="Machines per cloud(default:100)")
+    parser.add_argument('--volumes', type=int, default=50, help="Volumes per cloud(default:50)")
+    parser.add_argument('--record-size', type=int, default=0, help="Extra bytes of padding per record(default:0)")
+    parser.add_argument('--action-delay', type=float, default=2, help="Seconds a machine stays pending after an action(default:2)")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    return parser.parse_args()
+
+def main():
+    args = parse_argument()
+    server = make_server(host=args.host, port=args.port, latency=args.latency, jitter=args.jitter,
+                         error_rate=args.error_rate, verbose=args.verbose, platforms=args.platforms,
+                         clouds=args.clouds, clusters=args.clusters, hosts=args.hosts,
+                         machines=args.machines, volumes=args.volumes, record_size=args.record_size,
+                         action_delay=args.action_delay)
+    print(f'stub mist API listening on {server.server_address[0]}:{server.server_address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()